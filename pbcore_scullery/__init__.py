@@ -1 +1 @@
-from .framify import tablify, inframe
+from .framify import tablify, inframe, diff_snapshots, shard_filepaths
@@ -6,6 +6,12 @@ import os
 import glob
 import xml.etree.ElementTree as ET
 import csv
+import sys
+import hashlib
+import json
+import heapq
+import itertools
+import tempfile
 from pprint import pprint
 
 # import installed modules
@@ -56,6 +62,29 @@ def get_filepaths( pbcore_dir:str ):
     return xmlfilepaths
 
 
+def shard_filepaths( xmlfilepaths:list, shard:int, num_shards:int ) -> list:
+    """
+    Takes a list of filepaths of PBCore XML docs, a shard number from 1 to
+    `num_shards`, and the total number of shards.
+
+    Returns the filepaths belonging to that shard.  Files are assigned by a
+    hash of their filename (not the full path), so every host puts a file in
+    the same shard, and the shards together cover every file exactly once.
+    """
+
+    if not 1 <= shard <= num_shards:
+        raise Exception(f"Invalid shard {shard}/{num_shards}.")
+
+    shardpaths = []
+    for xmlfilepath in xmlfilepaths:
+        filename = os.path.basename(xmlfilepath)
+        digest = hashlib.md5(filename.encode("utf-8")).hexdigest()
+        if int(digest, 16) % num_shards == shard - 1:
+            shardpaths.append(xmlfilepath)
+
+    return shardpaths
+
+
 def tablify( xmlfilepaths:list ) -> (list, list):
     """
     Takes a list of filepaths of PBCore XML docs.
@@ -581,16 +610,47 @@ def dictify( xmlfilepath:str ) -> (dict, list):
 ############################################################################
 # %%
 # Define infrmae function
+
+# Columns of the asset and instantiation tables, as built by `dictify`.
+# These give an empty table the same columns as a populated one.
+ASST_COLUMNS = [
+    "asset_id", "aapb_pbcore_id", "sonyci_id",
+    "other_id_1", "other_id_2", "other_id_3",
+    "media_type", "asset_type", "contributing_organization",
+    "level_of_user_access", "special_collections",
+    "transcript_status", "transcript_url", "proxy_start_time",
+    "broadcast_date", "created_date", "copyright_date", "date", "single_date",
+    "series_title", "program_title", "episode_title", "episode_number",
+    "segment_title", "raw_footage_title", "promo_title", "clip_title",
+    "title", "consolidated_title",
+    "series_description", "program_description", "episode_description",
+    "segment_description", "raw_footage_description", "promo_description",
+    "clip_description", "description", "consolidated_description",
+    "producing_organization", "proxy_duration"
+]
+
+INST_COLUMNS = [
+    "asset_id", "inst_identifiers", "inst_media_type",
+    "inst_digital_format", "inst_physical_format", "inst_generations",
+    "inst_duration", "inst_location"
+]
+
 def inframe( assttbl, insttbl ):
     """
     Create dataframes from tables
     """
 
-    asstdf = pd.DataFrame(assttbl)
+    if assttbl:
+        asstdf = pd.DataFrame(assttbl)
+    else:
+        asstdf = pd.DataFrame(columns=ASST_COLUMNS)
 
-    instdf = pd.DataFrame(insttbl)
+    if insttbl:
+        instdf = pd.DataFrame(insttbl)
+    else:
+        instdf = pd.DataFrame(columns=INST_COLUMNS)
 
-    joindf = pd.merge(asstdf,instdf, how="left")
+    joindf = pd.merge(asstdf,instdf, how="left", on="asset_id")
 
     return (asstdf, instdf, joindf)
 
@@ -624,17 +684,394 @@ def write_csv( df, csv_filename: str ):
     df.to_csv(csv_filename, index=False)
 
 
+############################################################################
+# %%
+# Define functions for comparing two framify outputs
+# Number of (asset_id, digest) pairs sorted in memory at a time
+DIFF_CHUNK_ROWS = 100000
+
+def hash_csv( csv_filename: str, tmp_dir: str, chunk_rows: int = DIFF_CHUNK_ROWS ) -> (list, int):
+    """
+    Takes the path of a CSV file written by framify, a directory for 
+    temporary files, and the number of rows to sort in memory at a time.
+
+    Reads the file one row at a time and hashes each row.  The hashes are
+    written as `(asset_id, digest)` pairs to chunk files in `tmp_dir`, each
+    chunk sorted by `asset_id` and holding at most `chunk_rows` pairs.
+
+    Rows with an empty `asset_id` cannot be matched between snapshots, so
+    they are counted and left out.
+
+    Returns a pair:
+      * `chunk_filenames` - paths of the sorted chunk files
+      * `noid_rows`       - the number of rows with an empty `asset_id`
+    """
+
+    chunk_filenames = []
+    noid_rows = 0
+
+    def write_chunk( pairs ):
+        pairs.sort()
+        chunk_filename = os.path.join(tmp_dir, f"chunk{len(chunk_filenames)}.csv")
+        with open(chunk_filename, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(pairs)
+        chunk_filenames.append(chunk_filename)
+
+    with open(csv_filename, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return (chunk_filenames, noid_rows)
+        if "asset_id" not in header:
+            raise Exception(f"No asset_id column in {csv_filename}")
+
+        # Hash values in a fixed column order, so that reordered columns 
+        # do not count as changes
+        id_index = header.index("asset_id")
+        order = sorted(range(len(header)), key=lambda i: header[i])
+
+        pairs = []
+        for row in reader:
+            if not row:
+                continue
+            if id_index >= len(row):
+                raise Exception(f"No asset_id value on line {reader.line_num} of {csv_filename}")
+            if not row[id_index]:
+                noid_rows += 1
+                continue
+            values = [ header[i] + "=" + (row[i] if i < len(row) else "") 
+                       for i in order ]
+            digest = hashlib.sha1("\x1f".join(values).encode("utf-8")).hexdigest()
+            pairs.append([row[id_index], digest])
+            if len(pairs) >= chunk_rows:
+                write_chunk( pairs )
+                pairs = []
+        if pairs:
+            write_chunk( pairs )
+
+    return (chunk_filenames, noid_rows)
+
+
+def merge_digests( chunk_filenames: list ):
+    """
+    Takes a list of sorted chunk files written by `hash_csv`.
+
+    Merges the chunks in a single pass and combines the row digests of each
+    asset by adding them together (modulo 2**160), so the rows of an asset
+    can appear in any order.
+
+    Yields `(asset_id, digest)` pairs in `asset_id` order, one per asset.
+    """
+
+    files = [ open(chunk_filename, newline="", encoding="utf-8") 
+              for chunk_filename in chunk_filenames ]
+    try:
+        pairs = heapq.merge( *[ csv.reader(f) for f in files ] )
+        for asset_id, group in itertools.groupby(pairs, key=lambda pair: pair[0]):
+            total = 0
+            for pair in group:
+                total = (total + int(pair[1], 16)) % 2**160
+            yield (asset_id, f"{total:040x}")
+    finally:
+        for f in files:
+            f.close()
+
+
+def diff_snapshots( old_csv: str, new_csv: str, chunk_rows: int = DIFF_CHUNK_ROWS ):
+    """
+    Takes the paths of two CSV files written by framify.
+
+    Hashes both files into sorted chunk files on disk (see `hash_csv`), then
+    walks the two sorted streams of per-asset digests together.  Memory use
+    is bounded by `chunk_rows`, not by the size of the snapshots.
+
+    Yields `(asset_id, change)` pairs in `asset_id` order, where `change` is
+    one of:
+      * `added`   - the asset is in the new snapshot but not in the old one
+      * `removed` - the asset is in the old snapshot but not in the new one
+      * `changed` - the asset is in both but its asset or instantiation rows
+                    differ
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        old_dir = os.path.join(tmp_dir, "old")
+        new_dir = os.path.join(tmp_dir, "new")
+        os.mkdir(old_dir)
+        os.mkdir(new_dir)
+
+        old_chunks, old_noid = hash_csv(old_csv, old_dir, chunk_rows)
+        new_chunks, new_noid = hash_csv(new_csv, new_dir, chunk_rows)
+        for csv_filename, noid_rows in [(old_csv, old_noid), (new_csv, new_noid)]:
+            if noid_rows:
+                print(f"Warning: {noid_rows} rows in {csv_filename} have no asset_id and are not compared.")
+
+        old_digests = merge_digests(old_chunks)
+        new_digests = merge_digests(new_chunks)
+        old_pair = next(old_digests, None)
+        new_pair = next(new_digests, None)
+
+        while old_pair is not None or new_pair is not None:
+            if new_pair is None or (old_pair is not None and old_pair[0] < new_pair[0]):
+                yield (old_pair[0], "removed")
+                old_pair = next(old_digests, None)
+            elif old_pair is None or new_pair[0] < old_pair[0]:
+                yield (new_pair[0], "added")
+                new_pair = next(new_digests, None)
+            else:
+                if old_pair[1] != new_pair[1]:
+                    yield (old_pair[0], "changed")
+                old_pair = next(old_digests, None)
+                new_pair = next(new_digests, None)
+
+
+def write_diff_csv( changes, csv_filename: str ) -> dict:
+    # write out one row per differing asset, with the kind of change,
+    # and return the number of assets with each kind of change
+
+    counts = { "added": 0, "removed": 0, "changed": 0 }
+    with open(csv_filename, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["asset_id", "change"])
+        for asset_id, change in changes:
+            writer.writerow([asset_id, change])
+            counts[change] += 1
+
+    return counts
+
+
+def shard_info_filename( csv_filename: str ) -> str:
+    # the sidecar file recording which shard wrote a partial CSV
+
+    return csv_filename + ".shard.json"
+
+
+def write_shard_info( csv_filename: str, shard: int, num_shards: int, options: dict, 
+                      xmlfilepaths: list ):
+    # write out the shard number, framify options and the full set of files
+    # being sharded (as a count and a digest of the sorted filenames) next 
+    # to a partial CSV
+
+    filenames = sorted( os.path.basename(p) for p in xmlfilepaths )
+    info = { "shard": shard, 
+             "num_shards": num_shards, 
+             "options": options,
+             "num_files": len(filenames),
+             "files_digest": hashlib.sha1("\n".join(filenames).encode("utf-8")).hexdigest() }
+    with open(shard_info_filename(csv_filename), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+
+
+def read_shard_info( csv_filename: str ) -> dict:
+    # read the shard number and framify options of a partial CSV
+
+    info_filename = shard_info_filename(csv_filename)
+    if not os.path.isfile(info_filename):
+        raise Exception(f"No shard info file {info_filename} for partial {csv_filename}")
+    with open(info_filename, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_partials( partial_csvs: list ) -> list:
+    """
+    Takes a list of paths of partial CSV files written by framify shards.
+
+    Checks, before anything is merged, that the partials come from a single
+    sharded run:  all were written over the same set of XML files, with the
+    same number of shards and the same options, together they are exactly 
+    shards 1 to N, and all have the same columns.
+
+    Returns the shared header row.  Raises an exception on any mismatch.
+    """
+
+    infos = [ read_shard_info(partial_csv) for partial_csv in partial_csvs ]
+
+    first = infos[0]
+    for partial_csv, info in zip(partial_csvs, infos):
+        if info["num_shards"] != first["num_shards"]:
+            raise Exception(f"{partial_csv} is from a run with {info['num_shards']} shards, not {first['num_shards']}.")
+        if info["options"] != first["options"]:
+            raise Exception(f"{partial_csv} was written with options {info['options']}, not {first['options']}.")
+        if (info["num_files"], info["files_digest"]) != (first["num_files"], first["files_digest"]):
+            raise Exception(f"{partial_csv} was sharded from a different set of {info['num_files']} XML files, not the {first['num_files']} files of {partial_csvs[0]}.")
+
+    shards = [ info["shard"] for info in infos ]
+    duplicates = sorted( set( n for n in shards if shards.count(n) > 1 ) )
+    if duplicates:
+        raise Exception(f"Shards given more than once: {duplicates}")
+    missing = sorted( set(range(1, first["num_shards"] + 1)) - set(shards) )
+    if missing:
+        raise Exception(f"Shards missing: {missing} of {first['num_shards']}")
+
+    header = None
+    for partial_csv in partial_csvs:
+        with open(partial_csv, newline="", encoding="utf-8") as f:
+            partial_header = next(csv.reader(f), None)
+        if partial_header is None or "asset_id" not in partial_header:
+            raise Exception(f"No asset_id column in {partial_csv}")
+        if header is None:
+            header = partial_header
+        elif partial_header != header:
+            raise Exception(f"Columns of {partial_csv} do not match earlier partials.")
+
+    return header
+
+
+def merge_csvs( partial_csvs: list, csv_filename: str ) -> int:
+    """
+    Takes a list of paths of partial CSV files written by framify shards,
+    and the path of the CSV file to write.
+
+    Checks the partials with `check_partials`, then concatenates them one 
+    row at a time into a single CSV file.  The output is written to a 
+    temporary file and only moved into place once every partial has been 
+    merged.
+
+    Returns the number of rows written.
+    """
+
+    check_partials( partial_csvs )
+
+    nrows = 0
+
+    tmp_filename = csv_filename + ".tmp"
+    try:
+        with open(tmp_filename, "w", newline="", encoding="utf-8") as outf:
+            writer = csv.writer(outf)
+
+            for n, partial_csv in enumerate(partial_csvs):
+                partial_rows = 0
+                with open(partial_csv, newline="", encoding="utf-8") as f:
+                    reader = csv.reader(f)
+                    header = next(reader)
+                    if n == 0:
+                        writer.writerow(header)
+                    for row in reader:
+                        if not row:
+                            continue
+                        writer.writerow(row)
+                        partial_rows += 1
+
+                print(f"Merged:   {partial_rows} rows from {partial_csv}")
+                nrows += partial_rows
+
+        os.replace(tmp_filename, csv_filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    return nrows
+
+
+############################################################################
+def diff_main( argv: list ):
+
+    parser = argparse.ArgumentParser(
+        prog='framify diff',
+        description='Report added, removed and changed assets between two framify CSV outputs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument("-o", "--output", metavar="DIFF_CSV",
+        help="Path of a CSV file listing each differing asset and its change")
+    parser.add_argument("old_csv", metavar="OLD",
+        help="Path of the earlier framify CSV output")
+    parser.add_argument("new_csv", metavar="NEW",
+        help="Path of the later framify CSV output")
+
+    args = parser.parse_args(argv)
+
+    args_ok = True
+    for csv_filename in [args.old_csv, args.new_csv]:
+        if not os.path.isfile(csv_filename):
+            print("Error: File does not exist:", csv_filename)
+            args_ok = False
+
+    if args_ok:
+        changes = diff_snapshots( args.old_csv, args.new_csv )
+        try:
+            if args.output is not None:
+                print("Will write CSV file:", args.output)
+                counts = write_diff_csv( changes, args.output )
+            else:
+                counts = { "added": 0, "removed": 0, "changed": 0 }
+                for asset_id, change in changes:
+                    counts[change] += 1
+        except Exception as e:
+            print("Error:", e)
+            args_ok = False
+
+    if not args_ok:
+        sys.exit(1)
+
+    print(f"Added:    {counts['added']} assets.")
+    print(f"Removed:  {counts['removed']} assets.")
+    print(f"Changed:  {counts['changed']} assets.")
+    print("Done.")
+
+
+############################################################################
+def merge_main( argv: list ):
+
+    parser = argparse.ArgumentParser(
+        prog='framify merge',
+        description='Combine partial CSV outputs of sharded framify runs into a single CSV',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument("batch_csv", metavar="OUTPUT",
+        help="Path of the merged CSV file")
+    parser.add_argument("partial_csvs", metavar="PARTIAL", nargs="+",
+        help="Paths of the partial CSV files written with --shard")
+
+    args = parser.parse_args(argv)
+
+    args_ok = True
+    for csv_filename in args.partial_csvs:
+        if not os.path.isfile(csv_filename):
+            print("Error: File does not exist:", csv_filename)
+            args_ok = False
+
+    if args_ok:
+        print("Will write CSV file:", args.batch_csv)
+        try:
+            nrows = merge_csvs( args.partial_csvs, args.batch_csv )
+        except Exception as e:
+            print("Error:", e)
+            args_ok = False
+
+    if not args_ok:
+        sys.exit(1)
+
+    print(f"Merged:   {nrows} rows in total.")
+    print("Done.")
+
+
 ############################################################################
 def main():
+
+    # A first argument of `diff` or `merge` names a subcommand, unless it
+    # is an existing path (a PBCore directory that happens to be so named)
+    if len(sys.argv) > 1 and not os.path.exists(sys.argv[1]):
+        if sys.argv[1] == "diff":
+            diff_main( sys.argv[2:] )
+            return
+        if sys.argv[1] == "merge":
+            merge_main( sys.argv[2:] )
+            return
     
     parser = parser = argparse.ArgumentParser(
         prog='framify',
         description='Fit PBCore XML data into a tabular structure and export as CSV',
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog='To combine sharded outputs, see `framify merge -h`.  To compare two outputs, see `framify diff -h`.'
     )
     
     parser.add_argument("-a", "--allcols", action="store_true",
         help="Include all inframed columns, not just default columns")
+    parser.add_argument("-j", "--joined", action="store_true",
+        help="Write one row per instantiation, joined with its asset columns")
+    parser.add_argument("-s", "--shard", metavar="i/N",
+        help="Process only shard i of N (numbered from 1) and write a partial output for `framify merge`")
     parser.add_argument("pbcore_dir", metavar="DIR", nargs="?",
         help="Path to directory containing PBCore XML files")
     parser.add_argument("batch_csv", metavar="OUTPUT", nargs="?",
@@ -659,8 +1096,20 @@ def main():
         print("Error: No OUTPUT supplied.  Run with -h for help.")
         args_ok = False
 
+    if args.shard is not None:
+        try:
+            shard, num_shards = [ int(n) for n in args.shard.split("/") ]
+        except ValueError:
+            shard = num_shards = 0
+        if not 1 <= shard <= num_shards:
+            print("Error: Invalid shard.  Use the form i/N, with i from 1 to N.")
+            args_ok = False
+
     if args_ok:
-        xmlfilepaths = get_filepaths( pbcore_dir )
+        xmlfilepaths = all_filepaths = get_filepaths( pbcore_dir )
+        if args.shard is not None:
+            xmlfilepaths = shard_filepaths( all_filepaths, shard, num_shards )
+            print(f"Shard:    {shard}/{num_shards} with {len(xmlfilepaths)} XML files.")
         assttbl, insttbl = tablify( xmlfilepaths )
         asstdf, instdf, joindf = inframe( assttbl, insttbl )
         
@@ -670,8 +1119,16 @@ def main():
             projected = filterproj_main( asstdf )
 
         print(f"Framfied: {len(projected)} PBCore documents.")
+
+        if args.joined:
+            inst_cols = [ c for c in instdf.columns if c != "asset_id" ]
+            projected = joindf[ list(projected.columns) + inst_cols ]
+
         print("Will write CSV file:", batch_csv)
         write_csv( projected, batch_csv )
+        if args.shard is not None:
+            options = { "allcols": args.allcols, "joined": args.joined }
+            write_shard_info( batch_csv, shard, num_shards, options, all_filepaths )
         print("Done.")
 
 
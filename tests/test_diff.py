@@ -0,0 +1,74 @@
+import sys
+
+import pytest
+
+from pbcore_scullery import framify
+from pbcore_scullery.framify import hash_csv, merge_digests, diff_snapshots
+
+
+def write_file( path, text ):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def asset_digests( csv_filename, tmp_path, chunk_rows=2 ):
+    tmp_dir = tmp_path / "chunks"
+    tmp_dir.mkdir(parents=True)
+    chunk_filenames, noid_rows = hash_csv(csv_filename, str(tmp_dir), chunk_rows)
+    return list(merge_digests(chunk_filenames))
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 1000])
+def test_diff_snapshots(tmp_path, chunk_rows):
+    old_csv = write_file(tmp_path / "old.csv",
+        "asset_id,inst_identifiers\n"
+        "a,a1\n"
+        "b,b1\n"
+        "c,c1\n"
+        "b,b2\n")
+    new_csv = write_file(tmp_path / "new.csv",
+        "asset_id,inst_identifiers\n"
+        "d,d1\n"
+        "b,b2\n"
+        "c,c2\n"
+        "b,b1\n")
+
+    changes = list(diff_snapshots(old_csv, new_csv, chunk_rows))
+
+    assert changes == [("a", "removed"), ("c", "changed"), ("d", "added")]
+
+
+def test_hash_csv_ignores_column_order(tmp_path):
+    csv1 = write_file(tmp_path / "1.csv", "asset_id,x\na,1\nb,2\n")
+    csv2 = write_file(tmp_path / "2.csv", "x,asset_id\n2,b\n1,a\n")
+
+    assert asset_digests(csv1, tmp_path / "1") == asset_digests(csv2, tmp_path / "2")
+
+
+def test_hash_csv_reports_missing_asset_id(tmp_path):
+    csv_filename = write_file(tmp_path / "short.csv", "x,y,asset_id\n1\n")
+
+    with pytest.raises(Exception, match="line 2"):
+        hash_csv(csv_filename, str(tmp_path))
+
+
+def test_diff_skips_rows_without_asset_id(tmp_path, capsys):
+    old_csv = write_file(tmp_path / "old.csv", "asset_id,x\n,1\na,1\n")
+    new_csv = write_file(tmp_path / "new.csv", "asset_id,x\n,2\n,3\na,1\n")
+
+    assert list(diff_snapshots(old_csv, new_csv)) == []
+    out = capsys.readouterr().out
+    assert f"1 rows in {old_csv} have no asset_id" in out
+    assert f"2 rows in {new_csv} have no asset_id" in out
+
+
+def test_diff_main_exits_on_error(monkeypatch, tmp_path, capsys):
+    good_csv = write_file(tmp_path / "good.csv", "asset_id\na\n")
+    bad_csv = write_file(tmp_path / "bad.csv", "x\n1\n")
+    monkeypatch.setattr(sys, "argv", ["framify", "diff", good_csv, bad_csv])
+
+    with pytest.raises(SystemExit) as e:
+        framify.main()
+
+    assert e.value.code == 1
+    assert "Error: No asset_id column" in capsys.readouterr().out
@@ -0,0 +1,166 @@
+import csv
+import os
+import sys
+
+import pytest
+
+from pbcore_scullery import framify
+from pbcore_scullery.framify import shard_filepaths, diff_snapshots, merge_csvs
+
+
+PBCORE_XML = """<pbcoreDescriptionDocument xmlns="http://www.pbcore.org/PBCore/PBCoreNamespace.html">
+<pbcoreIdentifier source="http://americanarchiveinventory.org">cpb-aacip/{n}</pbcoreIdentifier>
+<pbcoreTitle titleType="Program">Program {n}</pbcoreTitle>
+{insts}
+</pbcoreDescriptionDocument>
+"""
+
+PBCORE_INST = """<pbcoreInstantiation>
+<instantiationIdentifier>inst-{n}-{k}</instantiationIdentifier>
+<instantiationMediaType>Moving Image</instantiationMediaType>
+<instantiationDigital>video/mp4</instantiationDigital>
+</pbcoreInstantiation>"""
+
+NUM_FILES = 6
+NUM_SHARDS = 8
+
+
+@pytest.fixture
+def pbcore_dir(tmp_path):
+    # Some assets have no instantiations, some have several
+    xml_dir = tmp_path / "pbcore"
+    xml_dir.mkdir()
+    for n in range(NUM_FILES):
+        insts = "\n".join( PBCORE_INST.format(n=n, k=k) for k in range(n % 3) )
+        (xml_dir / f"{n}.xml").write_text(PBCORE_XML.format(n=n, insts=insts), encoding="utf-8")
+    return str(xml_dir)
+
+
+def run_framify(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["framify", *args])
+    framify.main()
+
+
+def read_rows(csv_filename):
+    with open(csv_filename, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def test_shards_partition_files(pbcore_dir):
+    xmlfilepaths = framify.get_filepaths(pbcore_dir)
+    shards = [ shard_filepaths(xmlfilepaths, i, NUM_SHARDS) for i in range(1, NUM_SHARDS + 1) ]
+
+    assert sorted( p for shard in shards for p in shard ) == sorted(xmlfilepaths)
+
+
+@pytest.mark.parametrize("options", [[], ["-a"], ["-j"], ["-a", "-j"]])
+def test_merged_shards_match_single_run(monkeypatch, tmp_path, pbcore_dir, options):
+    single_csv = str(tmp_path / "single.csv")
+    run_framify(monkeypatch, *options, pbcore_dir, single_csv)
+
+    partial_csvs = []
+    for i in range(1, NUM_SHARDS + 1):
+        partial_csv = str(tmp_path / f"part{i}.csv")
+        run_framify(monkeypatch, *options, "--shard", f"{i}/{NUM_SHARDS}", pbcore_dir, partial_csv)
+        partial_csvs.append(partial_csv)
+
+    # With more shards than files, some shards are empty
+    partial_rows = [ read_rows(partial_csv) for partial_csv in partial_csvs ]
+    assert any( len(rows) == 1 for rows in partial_rows )
+
+    merged_csv = str(tmp_path / "merged.csv")
+    run_framify(monkeypatch, "merge", merged_csv, *partial_csvs)
+
+    single_rows = read_rows(single_csv)
+    merged_rows = read_rows(merged_csv)
+    assert merged_rows[0] == single_rows[0]
+    assert sorted(merged_rows[1:]) == sorted(single_rows[1:])
+    assert list(diff_snapshots(single_csv, merged_csv)) == []
+
+
+def test_merge_rejects_bad_partials(monkeypatch, tmp_path, pbcore_dir):
+    partial_csvs = []
+    for i in range(1, 3):
+        partial_csv = str(tmp_path / f"part{i}.csv")
+        run_framify(monkeypatch, "--shard", f"{i}/2", pbcore_dir, partial_csv)
+        partial_csvs.append(partial_csv)
+    other_csv = str(tmp_path / "other.csv")
+    run_framify(monkeypatch, "-a", "--shard", "2/2", pbcore_dir, other_csv)
+
+    merged_csv = str(tmp_path / "merged.csv")
+
+    with pytest.raises(Exception, match="missing"):
+        merge_csvs(partial_csvs[:1], merged_csv)
+    with pytest.raises(Exception, match="more than once"):
+        merge_csvs(partial_csvs + partial_csvs[:1], merged_csv)
+    with pytest.raises(Exception, match="options"):
+        merge_csvs([partial_csvs[0], other_csv], merged_csv)
+
+    assert not os.path.exists(merged_csv)
+    assert not os.path.exists(merged_csv + ".tmp")
+
+
+def test_merge_matches_single_run_with_repeated_asset_ids(monkeypatch, tmp_path):
+    # Documents without an AAPB identifier all get an empty asset_id, and
+    # identifiers can normalize to the same asset_id
+    xml_dir = tmp_path / "pbcore"
+    xml_dir.mkdir()
+    for n in range(6):
+        text = PBCORE_XML.format(n=n, insts="")
+        if n < 4:
+            text = text.replace('source="http://americanarchiveinventory.org"', 'source="Other"')
+        (xml_dir / f"{n}.xml").write_text(text, encoding="utf-8")
+    (xml_dir / "4.xml").write_text(PBCORE_XML.format(n="x/1", insts=""), encoding="utf-8")
+    (xml_dir / "5.xml").write_text(PBCORE_XML.format(n="x_1", insts=""), encoding="utf-8")
+
+    single_csv = str(tmp_path / "single.csv")
+    run_framify(monkeypatch, str(xml_dir), single_csv)
+
+    partial_csvs = []
+    for i in range(1, 4):
+        partial_csv = str(tmp_path / f"part{i}.csv")
+        run_framify(monkeypatch, "--shard", f"{i}/3", str(xml_dir), partial_csv)
+        partial_csvs.append(partial_csv)
+
+    merged_csv = str(tmp_path / "merged.csv")
+    run_framify(monkeypatch, "merge", merged_csv, *partial_csvs)
+
+    assert sorted(read_rows(merged_csv)) == sorted(read_rows(single_csv))
+
+
+def test_merge_rejects_different_file_sets(monkeypatch, tmp_path, pbcore_dir):
+    part1_csv = str(tmp_path / "part1.csv")
+    run_framify(monkeypatch, "--shard", "1/2", pbcore_dir, part1_csv)
+    os.remove(os.path.join(pbcore_dir, "0.xml"))
+    part2_csv = str(tmp_path / "part2.csv")
+    run_framify(monkeypatch, "--shard", "2/2", pbcore_dir, part2_csv)
+
+    with pytest.raises(Exception, match="different set"):
+        merge_csvs([part1_csv, part2_csv], str(tmp_path / "merged.csv"))
+
+
+def test_merge_main_exits_on_error(monkeypatch, tmp_path, pbcore_dir, capsys):
+    partial_csv = str(tmp_path / "part1.csv")
+    run_framify(monkeypatch, "--shard", "1/2", pbcore_dir, partial_csv)
+
+    with pytest.raises(SystemExit) as e:
+        run_framify(monkeypatch, "merge", str(tmp_path / "merged.csv"), partial_csv)
+
+    assert e.value.code == 1
+    assert "Error: Shards missing" in capsys.readouterr().out
+
+
+def test_directory_named_like_a_subcommand(monkeypatch, tmp_path, pbcore_dir):
+    monkeypatch.chdir(tmp_path)
+    os.rename(pbcore_dir, tmp_path / "merge")
+    run_framify(monkeypatch, "merge", "out.csv")
+
+    assert len(read_rows(tmp_path / "out.csv")) == NUM_FILES + 1
+
+
+def test_inframe_keeps_all_keys():
+    asstdf, instdf, joindf = framify.inframe([{"asset_id": "a", "extra": "x"}], [])
+
+    assert "extra" in asstdf.columns
+    assert list(instdf.columns) == framify.INST_COLUMNS
+    assert len(joindf) == 1